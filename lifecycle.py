@@ -0,0 +1,89 @@
+import os
+import signal
+import asyncio
+import logging
+import threading
+from typing import Dict, Any, Callable
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+logger = logging.getLogger(__name__)
+
+
+def mongo_client_options() -> Dict[str, Any]:
+    """Настройки пула соединений MongoDB из переменных окружения."""
+    options = {
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "5")),
+        "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000")),
+        "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    }
+    wait_queue_timeout = os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS")
+    if wait_queue_timeout:
+        options["waitQueueTimeoutMS"] = int(wait_queue_timeout)
+    return options
+
+
+def create_mongo_client(mongo_uri: str) -> AsyncIOMotorClient:
+    return AsyncIOMotorClient(mongo_uri, **mongo_client_options())
+
+
+async def warm_up_mongo(client: AsyncIOMotorClient, connections: int) -> None:
+    """
+    Выполняет discovery и открывает не меньше `connections` соединений параллельными ping-ами,
+    чтобы первые запросы после деплоя не платили за установку соединений.
+    """
+    await client.admin.command("ping")
+    if connections > 1:
+        await asyncio.gather(*(client.admin.command("ping") for _ in range(connections)))
+
+
+async def ping_mongo(client: AsyncIOMotorClient, timeout: float) -> bool:
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), timeout=timeout)
+        return True
+    except Exception as e:
+        logger.warning("MongoDB ping failed: %s", e)
+        return False
+
+
+def install_prestop_hook(on_signal: Callable[[], None], delay: float) -> Callable[[], None]:
+    """
+    Перехватывает SIGTERM перед обработчиком сервера (uvicorn ставит свой до lifespan startup).
+    SIGINT (Ctrl+C при локальном запуске) не трогаем - он останавливает сервер сразу.
+    По первому сигналу сразу вызывает on_signal (приложение перестает быть ready), а исходный
+    обработчик - через delay секунд: пока балансировщик видит 503 на /readyz, сервер еще принимает
+    соединения. Повторный сигнал передается серверу сразу. Возвращает функцию восстановления обработчиков.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        # Например, TestClient запускает lifespan не в главном потоке - сигналы там не перехватить
+        return lambda: None
+
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
+    if not callable(previous):
+        logger.warning("Обработчик SIGTERM не установлен сервером, pre-stop задержка не применяется")
+        return lambda: None
+    received = []
+
+    def handler(sig, frame):
+        if received:
+            previous(sig, frame)
+            return
+        received.append(sig)
+        on_signal()
+        # В обработчике сигнала не логируем: QueueHandler берет lock, который может держать прерванный код
+        loop.call_soon_threadsafe(schedule_stop, sig, frame)
+
+    def schedule_stop(sig, frame):
+        logger.info("Получен SIGTERM: /readyz отвечает 503, остановка сервера через %s с", delay)
+        loop.call_later(delay, previous, sig, frame)
+
+    signal.signal(signal.SIGTERM, handler)
+
+    def restore():
+        if signal.getsignal(signal.SIGTERM) is handler:
+            signal.signal(signal.SIGTERM, previous)
+
+    return restore
@@ -0,0 +1,212 @@
+import os
+import re
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any
+
+# Ключи, значения которых нельзя писать в логи как есть
+SENSITIVE_KEYS = {
+    "rectoken", "rec_token",
+    "cardpan", "card_pan", "card_pan_mask",
+    "merchantsignature", "merchant_signature", "signature",
+    "merchantpassword", "merchant_password",
+    "email", "clientemail", "email_from_payment",
+    "phone", "clientphone", "phone_from_payment",
+    "authcode",
+}
+REDACTED = "***"
+
+# Ищет пары ключ/значение в уже отрендеренных строках: 'recToken': 'abc', "cardPan": "4444...", recToken=abc.
+# Значение в кавычках маскируется целиком до закрывающей кавычки (в нем могут быть пробелы) или до конца
+# строки, если закрывающей кавычки нет - например, сообщение обрезано через %.1000s посреди значения
+_SENSITIVE_PAIR_RE = re.compile(
+    r"""(?P<key>['"]?(?:%s)['"]?\s*[:=]\s*)(?:(?P<quote>['"])(?P<quoted>.*?)(?:(?P=quote)|$)|(?P<value>[^'",\s}\]]+))""" % "|".join(
+        sorted((re.escape(k) for k in SENSITIVE_KEYS), key=len, reverse=True)
+    ),
+    re.IGNORECASE,
+)
+
+# Стандартные атрибуты LogRecord, все остальное считаем структурными полями из extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def redact(value: Any) -> Any:
+    """Возвращает копию значения, в которой чувствительные поля заменены на ***."""
+    if isinstance(value, dict):
+        return {k: (REDACTED if str(k).lower() in SENSITIVE_KEYS and v else redact(v)) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(redact(v) for v in value)
+    if isinstance(value, str):
+        return _SENSITIVE_PAIR_RE.sub(lambda m: f"{m.group('key')}{m.group('quote') or ''}{REDACTED}{m.group('quote') or ''}", value)
+    return value
+
+
+class RedactingFilter(logging.Filter):
+    """Маскирует чувствительные данные в аргументах и полях extra. Итоговый текст маскирует JsonFormatter."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.args, dict):
+            record.args = redact(record.args)
+        elif record.args:
+            record.args = tuple(redact(a) for a in record.args)
+        for key in set(vars(record)) - _RECORD_ATTRS:
+            value = getattr(record, key)
+            setattr(record, key, REDACTED if key.lower() in SENSITIVE_KEYS and value else redact(value))
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только долю INFO/DEBUG записей для выбранных логгеров.
+    WARNING и выше проходят всегда. Правило для логгера действует и на его дочерние логгеры.
+    """
+
+    def __init__(self, rates: Optional[Dict[str, float]] = None):
+        super().__init__()
+        self.rates: Dict[str, float] = dict(rates or {})
+
+    def _rate_for(self, name: str) -> float:
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return 1.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or not self.rates:
+            return True
+        rate = self._rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись. Сообщение рендерится здесь, т.е. уже в фоновом потоке."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact(record.getMessage()),
+        }
+        for key in set(vars(record)) - _RECORD_ATTRS:
+            entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _snapshot(value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        try:
+            return copy.deepcopy(value)
+        except Exception:
+            return copy.copy(value)
+    return value
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который не форматирует запись в вызывающем потоке.
+    Стандартный prepare() рендерит сообщение на event loop — здесь это делает QueueListener.
+    Аргументы-словари и списки копируются при постановке в очередь, так как код может менять их
+    после вызова логгера. Остальные изменяемые объекты (например, Pydantic-модели) после
+    передачи в логгер менять нельзя: они будут прочитаны уже в фоновом потоке.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if isinstance(record.args, dict):
+            record.args = _snapshot(record.args)
+        elif record.args:
+            record.args = tuple(_snapshot(a) for a in record.args)
+        return record
+
+
+sampling_filter = SamplingFilter()
+
+
+def parse_sampling_rates(spec: Optional[str]) -> Dict[str, float]:
+    """Разбирает строку вида 'main=0.1,main.webhook=0.5' в словарь {логгер: доля}."""
+    rates: Dict[str, float] = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        name, _, rate = item.partition("=")
+        try:
+            rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+
+def setup_logging(level: Optional[str] = None, sampling: Optional[str] = None) -> None:
+    """
+    Настраивает root-логгер: записи уходят в очередь, а вывод в stderr в формате JSON
+    выполняет фоновый поток. Уровень и сэмплинг берутся из LOG_LEVEL и LOG_SAMPLING.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+    stream_handler.addFilter(RedactingFilter())
+
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(sampling_filter)
+    sampling_filter.rates = parse_sampling_rates(sampling if sampling is not None else os.getenv("LOG_SAMPLING"))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel((level or os.getenv("LOG_LEVEL") or "INFO").upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """Останавливает фоновый поток, предварительно дописав все записи из очереди."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def set_log_level(level: str, logger_name: Optional[str] = None) -> str:
+    """Меняет уровень логгера (по умолчанию root) без перезапуска. Возвращает установленный уровень."""
+    level_name = level.upper()
+    if not isinstance(logging.getLevelName(level_name), int):
+        raise ValueError(f"Unknown log level: {level}")
+    logging.getLogger(logger_name).setLevel(level_name)
+    return level_name
+
+
+def set_sampling_rate(logger_name: str, rate: Optional[float]) -> None:
+    """Задает долю INFO-записей для логгера; None убирает правило."""
+    if rate is None:
+        sampling_filter.rates.pop(logger_name, None)
+    else:
+        sampling_filter.rates[logger_name] = min(max(float(rate), 0.0), 1.0)
+
+
+def get_logging_state() -> Dict[str, Any]:
+    root = logging.getLogger()
+    levels = {"root": logging.getLevelName(root.level)}
+    for name, obj in logging.Logger.manager.loggerDict.items():
+        if isinstance(obj, logging.Logger) and obj.level != logging.NOTSET:
+            levels[name] = logging.getLevelName(obj.level)
+    return {"levels": levels, "sampling": dict(sampling_filter.rates)}
@@ -1,4 +1,5 @@
 import os
+import asyncio
 import hmac
 import hashlib
 import base64
@@ -7,21 +8,28 @@ import json
 from datetime import datetime, timedelta, date
 from dateutil.relativedelta import relativedelta
 from fastapi import FastAPI, Request, HTTPException, APIRouter, Body
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, JSONResponse
 from pydantic import BaseModel
 from datetime import datetime, timedelta, date
 from typing import List, Optional, Dict, Any, Union
+from contextlib import asynccontextmanager
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import logging
 import aiohttp
+from logging_setup import REDACTED, setup_logging, set_log_level, set_sampling_rate, get_logging_state
 from pytz import timezone 
+import rollups
+import order_refs
+from profiling import ProfilingMiddleware, profile_store
+import lifecycle
 
 load_dotenv()
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 MONGO_URI = os.getenv("MONGO_URI")
@@ -30,10 +38,88 @@ WAYFORPAY_SECRET_KEY = os.getenv("WAYFORPAY_SECRET_KEY")
 WAYFORPAY_MERCHANT_PASSWORD = os.getenv("WAYFORPAY_MERCHANT_PASSWORD")
 WAYFORPAY_DOMAIN = os.getenv("WAYFORPAY_DOMAIN")
 
-mongo_client = AsyncIOMotorClient(MONGO_URI)
-db = mongo_client["dream_database"]
+# Клиент MongoDB создается в lifespan с настройками пула из lifecycle.mongo_client_options()
+mongo_client: Optional[AsyncIOMotorClient] = None
+db = None
+
+# Состояние для /readyz и остановки
+app_ready = False
+shutting_down = False
+MONGO_WARMUP_RETRY_SECONDS = float(os.getenv("MONGO_WARMUP_RETRY_SECONDS", "5"))
+READINESS_PING_TIMEOUT_SECONDS = float(os.getenv("READINESS_PING_TIMEOUT_SECONDS", "1"))
+# Остановка без потери веб-хуков:
+# 1. По SIGTERM /readyz сразу отвечает 503, а сервер продолжает принимать запросы еще
+#    PRESTOP_DELAY_SECONDS - этого должно хватить балансировщику, чтобы вывести инстанс
+#    (интервал проверки * порог неудачных проверок).
+# 2. Затем uvicorn перестает принимать соединения и ждет завершения запросов в обработке.
+#    Ожидание ограничивается флагом запуска: uvicorn main:app --timeout-graceful-shutdown 30
+# 3. После этого lifespan закрывает соединения с MongoDB.
+PRESTOP_DELAY_SECONDS = float(os.getenv("PRESTOP_DELAY_SECONDS", "10"))
+
+def check_config():
+    """Проверяет конфигурацию при старте, чтобы ошибки были видны сразу, а не на первом платеже."""
+    required = {
+        "MONGO_URI": MONGO_URI,
+        "WAYFORPAY_MERCHANT_ACCOUNT": WAYFORPAY_MERCHANT_ACCOUNT,
+        "WAYFORPAY_SECRET_KEY": WAYFORPAY_SECRET_KEY,
+        "WAYFORPAY_MERCHANT_PASSWORD": WAYFORPAY_MERCHANT_PASSWORD,
+        "WAYFORPAY_DOMAIN": WAYFORPAY_DOMAIN,
+    }
+    missing = [name for name, value in required.items() if not value]
+    if missing:
+        logger.error("Не заданы переменные окружения: %s", ", ".join(missing))
+    # Загружаем таймзону заранее: pytz кэширует ее после первого обращения
+    timezone('Europe/Kyiv')
+
+async def ensure_indexes():
+    try:
+        await rollups.ensure_rollup_indexes(db)
+        await order_refs.ensure_payment_attempt_indexes(db)
+    except Exception as e:
+        logger.error("Не удалось создать индексы: %s", e)
 
-app = FastAPI()
+async def warm_up():
+    """Прогрев пула и индексы. Пока Mongo недоступна, повторяем попытки, /readyz отвечает 503."""
+    global app_ready
+    min_connections = lifecycle.mongo_client_options()["minPoolSize"]
+    while not shutting_down:
+        try:
+            await lifecycle.warm_up_mongo(mongo_client, min_connections)
+            await ensure_indexes()
+            app_ready = True
+            logger.info("MongoDB доступна, пул прогрет (%s соединений). Приложение готово.", min_connections)
+            return
+        except Exception as e:
+            logger.error("Прогрев MongoDB не удался, повтор через %s с: %s", MONGO_WARMUP_RETRY_SECONDS, e)
+            await asyncio.sleep(MONGO_WARMUP_RETRY_SECONDS)
+
+def mark_shutting_down():
+    global app_ready, shutting_down
+    shutting_down = True
+    app_ready = False
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global mongo_client, db
+    check_config()
+    restore_signal_handlers = lifecycle.install_prestop_hook(mark_shutting_down, PRESTOP_DELAY_SECONDS)
+    mongo_client = lifecycle.create_mongo_client(MONGO_URI)
+    db = mongo_client["dream_database"]
+
+    # Первая попытка прогрева блокирует старт; если Mongo недоступна, продолжаем в фоне
+    warm_up_task = asyncio.create_task(warm_up())
+    await asyncio.wait({warm_up_task}, timeout=lifecycle.mongo_client_options()["serverSelectionTimeoutMS"] / 1000 + 1)
+
+    yield
+
+    # К этому моменту uvicorn уже дождался запросов в обработке (см. PRESTOP_DELAY_SECONDS выше)
+    mark_shutting_down()
+    warm_up_task.cancel()
+    restore_signal_handlers()
+    mongo_client.close()
+    logger.info("Приложение остановлено.")
+
+app = FastAPI(lifespan=lifespan)
 payment_api_router = APIRouter(prefix="/api/pay")
 
 # ❗ ПРОВЕРИТЬ/НАСТРОИТЬ: Убедитесь, что эти URL точны
@@ -42,6 +128,9 @@ FRONTEND_DOMAIN_WWW = "https://www.dreamcatcher.guru" # <--- 🟢 ДОБАВЛЕ
 FRONTEND_DOMAIN_NO_WWW = "https://dreamcatcher.guru" # На всякий случай, если иногда без www
 BACKEND_DOMAIN = "https://payapi.dreamcatcher.guru" # Если ваш API на другом поддомене
 
+# Токен для служебных эндпоинтов (статистика и т.п.), передается в заголовке X-Admin-Token
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")
+
 # URL для внутреннего API уведомлений бота
 BOT_NOTIFICATION_URL = os.getenv('BOT_NOTIFICATION_URL', 'http://157.90.119.107:8001/internal-api/notify') # <--- УКАЖИТЕ РЕАЛЬНЫЙ URL и порт!
 
@@ -65,6 +154,15 @@ app.add_middleware(
     max_age=600
 )
 
+# Выборочное профилирование запросов: по заголовку X-Profile-Token (= ADMIN_API_TOKEN)
+# или случайная доля запросов PROFILING_SAMPLE_RATE. По умолчанию выключено.
+app.add_middleware(
+    ProfilingMiddleware,
+    admin_token=ADMIN_API_TOKEN if os.getenv("PROFILING_ENABLED", "0") == "1" else None,
+    sample_rate=float(os.getenv("PROFILING_SAMPLE_RATE", "0")),
+    interval_ms=float(os.getenv("PROFILING_INTERVAL_MS", "5"))
+)
+
 class CheckoutSession(BaseModel):
     user_id: str
     plan_type: str
@@ -107,6 +205,17 @@ class WayForPayServiceWebhook(BaseModel):
 class CancelSubscriptionRequest(BaseModel):
     user_id: int
 
+class LoggingConfigRequest(BaseModel):
+    level: Optional[str] = None
+    logger_name: Optional[str] = None # None - root-логгер
+    sampling_rate: Optional[float] = None # Доля INFO-записей для logger_name, от 0 до 1
+    reset_sampling: bool = False
+
+def require_admin_token(request: Request):
+    token = request.headers.get("x-admin-token")
+    if not ADMIN_API_TOKEN or not token or not hmac.compare_digest(token, ADMIN_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
 def make_wayforpay_signature(secret_key: str, params_list: List[str]) -> str:
     sign_str = ';'.join(str(x) for x in params_list)
     # Для большинства API WayForPay подпись HMAC-MD5 в hex-формате
@@ -115,7 +224,7 @@ def make_wayforpay_signature(secret_key: str, params_list: List[str]) -> str:
 # main.py - предлагаемые исправления
 @payment_api_router.post("/get-widget-params")
 async def get_widget_payment_params(request_data: WidgetParamsRequest):
-    logger.info(f"Запрос на параметры для виджета (/api/pay/get-widget-params): {request_data}")
+    logger.info("Запрос на параметры для виджета (/api/pay/get-widget-params): %s", request_data)
 
     user_id_str = request_data.user_id
     plan_type = request_data.plan_type
@@ -135,7 +244,9 @@ async def get_widget_payment_params(request_data: WidgetParamsRequest):
         logger.error(f"Invalid plan_type '{plan_type}' received for widget params.")
         raise HTTPException(status_code=400, detail="Invalid plan_type. Allowed: 'subscription', 'single'.")
 
-    order_ref = f"{order_ref_prefix}_{user_id_str}_{int(datetime.utcnow().timestamp())}"
+    # orderReference = <prefix>_<user_id>_<ULID>: уникален даже для нескольких запросов в одну секунду
+    new_order = order_refs.make_order_reference(order_ref_prefix, user_id_str)
+    order_ref = new_order["orderReference"]
     order_date = int(datetime.utcnow().timestamp())
     
     base_backend_url = os.getenv('BACKEND_URL_BASE', 'https://payapi.dreamcatcher.guru')
@@ -154,11 +265,10 @@ async def get_widget_payment_params(request_data: WidgetParamsRequest):
     ]
     
     # Логируем строку, которая будет подписана
-    string_to_sign = ';'.join(str(x) for x in signature_params_list)
-    logger.info(f"Строка для подписи (String to sign): {string_to_sign}")
+    logger.debug("Строка для подписи (String to sign): %s", signature_params_list)
     
     merchant_signature = make_wayforpay_signature(WAYFORPAY_SECRET_KEY, signature_params_list)
-    logger.info(f"Сгенерированная подпись: {merchant_signature}")
+    logger.debug("Сгенерированная подпись: %s", merchant_signature)
 
     # Параметры, которые будут переданы в виджет
     widget_params_to_send = {
@@ -196,7 +306,7 @@ async def get_widget_payment_params(request_data: WidgetParamsRequest):
         }
         widget_params_to_send.update(regular_params_for_widget)
 
-    logger.info(f"Финальные параметры для виджета WayForPay (с подписью): {widget_params_to_send}")
+    logger.info("Финальные параметры для виджета WayForPay (с подписью): %s", widget_params_to_send)
     
     try:
         user_id_int = int(user_id_str)
@@ -206,6 +316,7 @@ async def get_widget_payment_params(request_data: WidgetParamsRequest):
 
     await db["payment_attempts"].insert_one({
         "orderReference": order_ref,
+        "order_id": new_order["order_id"],
         "user_id": user_id_int,
         "plan_type": plan_type,
         "amount": amount,
@@ -231,10 +342,10 @@ async def check_access_endpoint(user_id: str): # Переименовал, чт
     sub = await db["subscriptions"].find_one({"user_id": user_id_int}) 
     
     if sub and sub.get("is_active") == 1 and sub.get("subscription_end") >= today_kyiv_str:
-        logger.info(f"Доступ активен для user_id {user_id_int} через /api/pay/check-access. Дата окончания: {sub.get('subscription_end')}")
+        logger.info("Доступ активен для user_id %s через /api/pay/check-access. Дата окончания: %s", user_id_int, sub.get('subscription_end'))
         return {"active": True}
     
-    logger.info(f"Доступ неактивен для user_id {user_id_int} через /api/pay/check-access. Данные подписки: {sub}")
+    logger.info("Доступ неактивен для user_id %s через /api/pay/check-access. Данные подписки: %s", user_id_int, sub)
     return {"active": False}
 
 async def send_telegram_notification_to_user(user_id: int, message_key_or_text: str, details: Optional[dict] = None):
@@ -281,9 +392,9 @@ async def send_telegram_notification_to_admin(message: str, details: Optional[di
 # --- Функция для генерации подписи ответа вашего serviceUrl для WayForPay ---
 def make_service_response_signature(secret_key: str, order_reference: str, status: str, time_unix: int) -> str:
     sign_str = f"{order_reference};{status};{str(time_unix)}"
-    logger.info(f"Service URL response string to sign: '{sign_str}'")
+    logger.debug("Service URL response string to sign: '%s'", sign_str)
     signature = hmac.new(secret_key.encode(), sign_str.encode(), hashlib.md5).hexdigest()
-    logger.info(f"Service URL response generated signature: '{signature}'")
+    logger.debug("Service URL response generated signature: '%s'", signature)
     return signature
 
 def verify_service_webhook_signature(secret_key: str, data: WayForPayServiceWebhook) -> bool:
@@ -307,9 +418,11 @@ def verify_service_webhook_signature(secret_key: str, data: WayForPayServiceWebh
     sign_str_to_check = ';'.join(fields_for_signature_check)
     expected_signature = hmac.new(secret_key.encode(), sign_str_to_check.encode(), hashlib.md5).hexdigest()
     
-    logger.info(f"Verifying service webhook signature. String: '{sign_str_to_check}', Expected: '{expected_signature}', Received: '{data.merchantSignature}'")
+    # В строке подписи поля идут без имен, поэтому redact() их не найдет: authCode и cardPan маскируем здесь
+    fields_for_log = [REDACTED if i in (4, 5) and value else value for i, value in enumerate(fields_for_signature_check)]
+    logger.debug("Verifying service webhook signature. String: '%s', Expected: '%s', Received: '%s'", ';'.join(fields_for_log), expected_signature, data.merchantSignature)
     if expected_signature == data.merchantSignature:
-        logger.info(f"Service webhook signature VERIFIED for OrderRef: {data.orderReference}")
+        logger.info("Service webhook signature VERIFIED for OrderRef: %s", data.orderReference)
         return True
     else:
         logger.error(f"!!! Service webhook signature MISMATCH for OrderRef: {data.orderReference} !!!")
@@ -319,10 +432,10 @@ def verify_service_webhook_signature(secret_key: str, data: WayForPayServiceWebh
 @payment_api_router.post("/wayforpay-webhook", include_in_schema=False)
 async def wayforpay_webhook_handler(request: Request): # Принимаем только объект Request
     content_type = request.headers.get("content-type")
-    logger.info(f"ОТРИМАНО ВЕБ-ХУК. Content-Type: {content_type}")
+    logger.info("ОТРИМАНО ВЕБ-ХУК. Content-Type: %s", content_type)
 
     raw_body = await request.body() # Получаем сырые байты тела запроса
-    logger.info(f"RAW Webhook Body (bytes): {raw_body[:1000]}") # Логируем первые 1000 байт сырого тела
+    logger.debug("RAW Webhook Body (bytes): %s", raw_body[:1000]) # Логируем первые 1000 байт сырого тела
 
     data_to_process = {} # Словарь для данных после парсинга
 
@@ -333,10 +446,10 @@ async def wayforpay_webhook_handler(request: Request): # Принимаем то
         try:
             body_str_for_parsing = raw_body.decode('utf-8')
         except UnicodeDecodeError as e_unicode:
-            logger.error(f"UnicodeDecodeError when decoding raw body: {e_unicode}. Body (partial bytes): {raw_body[:100]}")
+            logger.error("UnicodeDecodeError when decoding raw body: %s. Body (partial bytes): %s", e_unicode, raw_body[:100])
             raise ValueError(f"Cannot decode raw body from UTF-8: {e_unicode}") # Прерываем выполнение, если не можем декодировать
 
-        logger.info(f"Attempting to parse the entire DECODED body string as JSON. Decoded body for parsing: {body_str_for_parsing[:1000]}")
+        logger.debug("Attempting to parse the entire DECODED body string as JSON. Decoded body for parsing: %.1000s", body_str_for_parsing)
 
         if not body_str_for_parsing.strip(): # Проверяем, не пустая ли строка после удаления пробелов
             logger.warning("Decoded body string is empty or whitespace. Cannot parse as JSON.")
@@ -347,25 +460,25 @@ async def wayforpay_webhook_handler(request: Request): # Принимаем то
 
         # Проверка, что результат парсинга - это словарь
         if not isinstance(data_to_process, dict):
-            logger.error(f"Parsing decoded body as JSON did not result in a dictionary. Parsed type: {type(data_to_process)}. Data: {str(data_to_process)[:1000]}")
+            logger.error("Parsing decoded body as JSON did not result in a dictionary. Parsed type: %s. Data: %.1000s", type(data_to_process), data_to_process)
             raise ValueError(f"Expected a JSON object (dict) after parsing, but got {type(data_to_process)}")
             
         # Если data_to_process пустой словарь {} (валидный JSON), Pydantic это отловит ниже, если поля обязательные
         # Поэтому отдельная проверка if not data_to_process не так критична здесь, если это dict.
 
-        logger.info(f"Данні веб-хука для Pydantic валідації (Parsed Dict from decoded body): {str(data_to_process)[:1000]}")
+        logger.debug("Данні веб-хука для Pydantic валідації (Parsed Dict from decoded body): %.1000s", data_to_process)
             
         # Теперь попытка валидации через Pydantic с полученным словарем data_to_process
         webhook_data = WayForPayServiceWebhook(**data_to_process)
-        logger.info(f"Веб-хук УСПІШНО провалідований Pydantic: {webhook_data.model_dump_json(indent=2)[:1000]}")
+        logger.info("Веб-хук УСПІШНО провалідований Pydantic: %.1000s", webhook_data)
 
     except Exception as e_parse_or_pydantic: # Ловим ошибки парсинга ИЛИ Pydantic валидации
         logger.error(f"!!! ПОМИЛКА ОБРОБКИ/ВАЛІДАЦІЇ ВЕБ-ХУКА !!!: {e_parse_or_pydantic}")
         # Логируем данные, которые вызвали ошибку (если они были получены)
         if data_to_process: # Если data_to_process было как-то заполнено до ошибки
-            logger.error(f"Дані, що викликали помилку (data_to_process): {str(data_to_process)[:1000]}")
-        else: # Если data_to_process пустое (например, ошибка на этапе json.loads(body_str_for_log))
-            logger.error(f"Дані, що викликали помилку (body_str_for_log): {body_str_for_log[:1000]}")
+            logger.error("Дані, що викликали помилку (data_to_process): %.1000s", data_to_process)
+        else: # Если data_to_process пустое (например, ошибка декодирования или json.loads)
+            logger.error("Дані, що викликали помилку (raw_body): %s", raw_body[:1000])
 
         # Формируем ответ для WayForPay даже при ошибке
         # Пытаемся извлечь orderReference из сырых данных или data_to_process для ответа
@@ -374,7 +487,7 @@ async def wayforpay_webhook_handler(request: Request): # Принимаем то
             temp_order_ref = data_to_process.get("orderReference")
         else: # Попытка найти orderReference в сырой строке (если парсинг до словаря не удался)
             try:
-                match_order_ref = re.search(r'"orderReference"\s*:\s*"([^"]+)"', body_str_for_log)
+                match_order_ref = re.search(r'"orderReference"\s*:\s*"([^"]+)"', raw_body.decode("utf-8", "replace"))
                 if match_order_ref:
                     temp_order_ref = match_order_ref.group(1)
             except Exception:
@@ -395,28 +508,53 @@ async def wayforpay_webhook_handler(request: Request): # Принимаем то
         return {"orderReference": webhook_data.orderReference, "status": "accept", "time": response_time_unix, "signature": response_sig}
     # Если раскомментируете проверку выше, дальнейший код будет выполняться только при верной подписи.
 
-    # Извлечение telegram_user_id из orderReference
-    match = re.search(r"_(?P<user_id>\d+)_", webhook_data.orderReference)
-    if not match:
-        logger.error(f"Could not extract user_id from orderReference: {webhook_data.orderReference}")
-        response_time_unix = int(datetime.utcnow().timestamp())
-        response_sig = make_service_response_signature(WAYFORPAY_SECRET_KEY, webhook_data.orderReference, "accept", response_time_unix)
-        return {"orderReference": webhook_data.orderReference, "status": "accept", "time": response_time_unix, "signature": response_sig}
-
-    telegram_user_id = int(match.group("user_id"))
-
     # Обновляем запись о попытке платежа (или создаем, если это первый веб-хук по этому orderReference)
-    await db["payment_attempts"].update_one(
+    # Берем документ ДО обновления, чтобы учитывать в агрегатах только смену статуса, а не повторы веб-хука.
+    # Поиск идет по уникальному индексу orderReference, из того же документа берем telegram_user_id
+    attempt_update = {"$set": {
+        "status": webhook_data.transactionStatus, 
+        "wfp_webhook_received_utc": datetime.utcnow(),
+        "wfp_webhook_data": webhook_data.model_dump()
+        }
+    }
+    if webhook_data.transactionStatus == "Approved":
+        # Время первого одобрения: по нему rebuild_rollups относит выручку возвращенных платежей на тот же день
+        attempt_update["$min"] = {"approved_utc": datetime.utcnow()}
+    previous_attempt = await db["payment_attempts"].find_one_and_update(
         {"orderReference": webhook_data.orderReference},
-        {"$set": {
-            "status": webhook_data.transactionStatus, 
-            "wfp_webhook_received_utc": datetime.utcnow(),
-            "wfp_webhook_data": webhook_data.model_dump()
-            }
-        },
-        upsert=True # Создаст запись, если такой orderReference еще не было
+        attempt_update,
+        projection={"_id": 0, "user_id": 1, "plan_type": 1, "status": 1},
+        upsert=True, # Создаст запись, если такой orderReference еще не было
+        return_document=ReturnDocument.BEFORE
     )
 
+    # Извлечение telegram_user_id: из попытки платежа, для неизвестных попыток - разбором orderReference
+    telegram_user_id = (previous_attempt or {}).get("user_id")
+    if telegram_user_id is None:
+        parsed_order_ref = order_refs.parse_order_reference(webhook_data.orderReference)
+        if not parsed_order_ref:
+            logger.error(f"Could not extract user_id from orderReference: {webhook_data.orderReference}")
+            response_time_unix = int(datetime.utcnow().timestamp())
+            response_sig = make_service_response_signature(WAYFORPAY_SECRET_KEY, webhook_data.orderReference, "accept", response_time_unix)
+            return {"orderReference": webhook_data.orderReference, "status": "accept", "time": response_time_unix, "signature": response_sig}
+        telegram_user_id = parsed_order_ref.user_id
+        await db["payment_attempts"].update_one(
+            {"orderReference": webhook_data.orderReference},
+            {"$set": {"user_id": telegram_user_id, "order_id": parsed_order_ref.order_id}} if parsed_order_ref.order_id
+            else {"$set": {"user_id": telegram_user_id}}
+        )
+    plan_type = (previous_attempt or {}).get("plan_type") or rollups.plan_type_from_order_ref(webhook_data.orderReference)
+    status_changed = (previous_attempt or {}).get("status") != webhook_data.transactionStatus
+
+    if status_changed:
+        try:
+            await rollups.record_payment_status(
+                db, plan_type, webhook_data.transactionStatus, webhook_data.amount,
+                previous_status=(previous_attempt or {}).get("status")
+            )
+        except Exception as e:
+            logger.error("Error updating revenue rollups for OrderRef %s: %s", webhook_data.orderReference, e)
+
     if webhook_data.transactionStatus == "Approved":
         logger.info(f"Payment APPROVED for orderReference: {webhook_data.orderReference}, user_id: {telegram_user_id}")
         
@@ -424,7 +562,7 @@ async def wayforpay_webhook_handler(request: Request): # Принимаем то
         if not rec_token:
             logger.warning(f"REC TOKEN IS EMPTY for successful payment! OrderRef: {webhook_data.orderReference}. Automatic renewals will not be possible.")
         else:
-            logger.info(f"Received recToken: {rec_token} for OrderRef: {webhook_data.orderReference}")
+            logger.info("Received recToken: %s for OrderRef: %s", rec_token, webhook_data.orderReference)
 
         try:
             kyiv_tz = timezone('Europe/Kyiv')
@@ -450,7 +588,9 @@ async def wayforpay_webhook_handler(request: Request): # Принимаем то
             
             # Рассчитываем новую дату окончания. Если amount = 1 (тест), можно сделать подписку на 1 день для теста.git add .
             new_end_date_obj = start_date_obj + relativedelta(months=1)
+            was_active = bool(current_sub and current_sub.get("is_active"))
             update_fields = {
+                "plan_type": plan_type,
                 "subscription_start": start_date_obj.strftime("%Y-%m-%d"),
                 "subscription_end": new_end_date_obj.strftime("%Y-%m-%d"),
                 "is_active": 1,
@@ -470,8 +610,13 @@ async def wayforpay_webhook_handler(request: Request): # Принимаем то
                 {"$set": update_fields, "$setOnInsert": {"user_id": telegram_user_id, "created_at_utc": datetime.utcnow()}},
                 upsert=True
             )
+            if status_changed and not was_active:
+                try:
+                    await rollups.record_active_delta(db, plan_type, 1)
+                except Exception as e:
+                    logger.error("Error updating subscriber rollups for user_id %s: %s", telegram_user_id, e)
             # ... (после успешного обновления подписки в БД)
-            logger.info(f"Subscription activated/extended for user_id: {telegram_user_id} until {new_end_date_obj.strftime('%Y-%m-%d')}. RecToken: {rec_token}")
+            logger.info("Subscription activated/extended for user_id: %s until %s. RecToken: %s", telegram_user_id, update_fields["subscription_end"], rec_token)
 
             await send_telegram_notification_to_user(
                 user_id=telegram_user_id, 
@@ -551,13 +696,13 @@ async def cancel_subscription_endpoint(request_data: CancelSubscriptionRequest):
         "orderReference": order_ref_to_cancel
     }
     
-    logger.info(f"ОТПРАВКА В WAYFORPAY regularApi: {wfp_request_data}")
+    logger.info("ОТПРАВКА В WAYFORPAY regularApi: %s", wfp_request_data)
 
     try:
         async with aiohttp.ClientSession() as session:
             async with session.post(wfp_api_url, json=wfp_request_data) as resp:
                 response_data = await resp.json()
-                logger.info(f"Ответ от WayForPay на REMOVE для user_id {user_id}: {response_data}")
+                logger.info("Ответ от WayForPay на REMOVE для user_id %s: %s", user_id, response_data)
 
                 # 4. Проверяем ответ от WayForPay. Успешный код - 4100
                 if resp.status == 200 and response_data.get("reasonCode") == 4100:
@@ -579,4 +724,67 @@ async def cancel_subscription_endpoint(request_data: CancelSubscriptionRequest):
         logger.error(f"Исключение при удалении рекуррентного платежа для user_id {user_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error while cancelling subscription.")
     
+@payment_api_router.get("/stats/rollups", include_in_schema=False)
+async def get_rollups_endpoint(request: Request, start: str, end: Optional[str] = None, plan_type: Optional[str] = None):
+    """Дневные агрегаты выручки и подписок за период (даты YYYY-MM-DD по Киеву)."""
+    require_admin_token(request)
+    end = end or rollups.kyiv_day()
+    try:
+        datetime.strptime(start, "%Y-%m-%d")
+        datetime.strptime(end, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Expected YYYY-MM-DD.")
+    return await rollups.get_rollups(db, start, end, plan_type)
+
+@payment_api_router.get("/admin/logging", include_in_schema=False)
+async def get_logging_endpoint(request: Request):
+    require_admin_token(request)
+    return get_logging_state()
+
+@payment_api_router.post("/admin/logging", include_in_schema=False)
+async def update_logging_endpoint(request: Request, config: LoggingConfigRequest):
+    """Меняет уровень логирования и сэмплинг без перезапуска."""
+    require_admin_token(request)
+    if config.level:
+        try:
+            set_log_level(config.level, config.logger_name)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if config.sampling_rate is not None or config.reset_sampling:
+        if not config.logger_name:
+            raise HTTPException(status_code=400, detail="logger_name is required for sampling.")
+        set_sampling_rate(config.logger_name, None if config.reset_sampling else config.sampling_rate)
+    logger.warning("Logging config changed: %s", config)
+    return get_logging_state()
+
+@payment_api_router.get("/admin/profiles", include_in_schema=False)
+async def list_profiles_endpoint(request: Request):
+    """Последние профили запросов, сгруппированные по маршрутам."""
+    require_admin_token(request)
+    return profile_store.summaries()
+
+@payment_api_router.get("/admin/profiles/download", include_in_schema=False)
+async def download_profile_endpoint(request: Request, route: str, index: Optional[int] = None):
+    """Стеки в формате collapsed (flamegraph.pl, speedscope). Без index - сумма по всем профилям маршрута."""
+    require_admin_token(request)
+    collapsed = profile_store.collapsed(route, index)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="Profile not found.")
+    filename = route.strip("/").replace("/", "_") or "root"
+    return PlainTextResponse(collapsed, headers={"Content-Disposition": f'attachment; filename="{filename}.folded"'})
+
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    """Liveness: процесс жив и обрабатывает запросы, внешние зависимости не проверяются."""
+    return {"status": "ok"}
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    """Readiness: пул прогрет, Mongo отвечает на ping и приложение не останавливается."""
+    if not app_ready or shutting_down:
+        return JSONResponse(status_code=503, content={"status": "not_ready", "shutting_down": shutting_down})
+    if not await lifecycle.ping_mongo(mongo_client, READINESS_PING_TIMEOUT_SECONDS):
+        return JSONResponse(status_code=503, content={"status": "mongo_unavailable"})
+    return {"status": "ready"}
+
 app.include_router(payment_api_router)
\ No newline at end of file
@@ -0,0 +1,127 @@
+import os
+import re
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, NamedTuple
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Crockford base32, как в ULID: без I, L, O, U, лексикографический порядок совпадает с числовым
+_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_RANDOM_BITS = 80
+_RANDOM_MAX = (1 << _RANDOM_BITS) - 1
+ORDER_ID_LENGTH = 26
+
+# Формат orderReference: <prefix>_<user_id>_<suffix>, где prefix = widget_sub / widget_single.
+# suffix - ULID (новые заказы) или unix-секунды (старые заказы). После suffix WayForPay может
+# дописать свой хвост для регулярных списаний, поэтому он допускается, как и в прежнем regex
+_ORDER_REF_RE = re.compile(r"^(?P<prefix>.+?)_(?P<user_id>\d+)_(?P<suffix>[0-9A-Z]+)")
+_ORDER_ID_RE = re.compile(r"^[0-9A-HJKMNP-TV-Z]{%d}$" % ORDER_ID_LENGTH)
+
+_lock = threading.Lock()
+_last_ms = -1
+_last_random = 0
+
+
+class ParsedOrderReference(NamedTuple):
+    prefix: str
+    user_id: int
+    order_id: Optional[str]  # None для старых ссылок с unix-секундами
+
+
+def _encode(value: int) -> str:
+    chars = []
+    for _ in range(ORDER_ID_LENGTH):
+        chars.append(_ALPHABET[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+def new_order_id(timestamp_ms: Optional[int] = None) -> str:
+    """
+    ULID: 48 бит миллисекунд + 80 бит случайности, 26 символов.
+    В пределах одной миллисекунды значения монотонно растут, поэтому id уникальны и сортируются по времени.
+    С явным timestamp_ms (например, для старых попыток) id просто случайный: последовательность текущих id не меняется.
+    """
+    global _last_ms, _last_random
+    if timestamp_ms is not None:
+        return _encode((timestamp_ms << _RANDOM_BITS) | int.from_bytes(os.urandom(10), "big"))
+    ms = int(time.time() * 1000)
+    with _lock:
+        if ms <= _last_ms:
+            # Та же миллисекунда (или часы ушли назад): продолжаем последовательность предыдущего id
+            ms = _last_ms
+            _last_random += 1
+            if _last_random > _RANDOM_MAX:
+                ms += 1
+                _last_random = int.from_bytes(os.urandom(10), "big")
+        else:
+            _last_random = int.from_bytes(os.urandom(10), "big")
+        _last_ms = ms
+        return _encode((ms << _RANDOM_BITS) | _last_random)
+
+
+def order_id_timestamp(order_id: str) -> datetime:
+    """Время создания (UTC, naive - как остальные даты в БД), зашитое в order_id."""
+    value = 0
+    for char in order_id[:10]:
+        value = (value << 5) | _ALPHABET.index(char)
+    return datetime.fromtimestamp(value / 1000, timezone.utc).replace(tzinfo=None)
+
+
+def order_id_bound(dt: datetime, upper: bool = False) -> str:
+    """Минимальный (или максимальный) order_id для момента времени - для range-запросов по order_id."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    ms = int(dt.timestamp() * 1000)
+    return _encode((ms << _RANDOM_BITS) | (_RANDOM_MAX if upper else 0))
+
+
+def make_order_reference(prefix: str, user_id: Any) -> Dict[str, str]:
+    """Возвращает {"orderReference": ..., "order_id": ...} для новой попытки платежа."""
+    order_id = new_order_id()
+    return {"orderReference": f"{prefix}_{user_id}_{order_id}", "order_id": order_id}
+
+
+def parse_order_reference(order_reference: str) -> Optional[ParsedOrderReference]:
+    """Разбирает и новые (ULID), и старые (unix-секунды) orderReference. None, если user_id не найден."""
+    match = _ORDER_REF_RE.match(order_reference or "")
+    if not match:
+        return None
+    suffix = match.group("suffix")
+    return ParsedOrderReference(
+        prefix=match.group("prefix"),
+        user_id=int(match.group("user_id")),
+        # Для ссылок с хвостом (регулярные списания) order_id не выставляем: время в нем - время исходного заказа
+        order_id=suffix if _ORDER_ID_RE.match(suffix) and match.end() == len(order_reference) else None,
+    )
+
+
+def attempts_created_between(start: datetime, end: datetime, user_id: Optional[int] = None) -> Dict[str, Any]:
+    """Фильтр payment_attempts по времени создания через индекс по order_id (включая обе границы)."""
+    query: Dict[str, Any] = {"order_id": {"$gte": order_id_bound(start), "$lte": order_id_bound(end, upper=True)}}
+    if user_id is not None:
+        query["user_id"] = user_id
+    return query
+
+
+async def ensure_payment_attempt_indexes(db) -> None:
+    attempts = db["payment_attempts"]
+    # Веб-хук ищет попытку (и из нее user_id) по orderReference через find_one_and_update с upsert.
+    # Уникальность нужна, чтобы параллельные повторы веб-хука не создали две попытки: MongoDB
+    # повторяет upsert, упавший на уникальном индексе. В старых данных могут быть дубли (ссылки
+    # с unix-секундами совпадали в пределах секунды) - тогда создаем обычный индекс и пишем в лог
+    try:
+        await attempts.create_index([("orderReference", 1)], unique=True)
+    except OperationFailure as e:
+        logger.error(
+            "Не удалось создать уникальный индекс payment_attempts.orderReference (вероятно, есть дубли "
+            "старых orderReference, их нужно удалить вручную): %s", e
+        )
+        await attempts.create_index([("orderReference", 1)])
+    await attempts.create_index([("order_id", 1)], sparse=True)
+    await attempts.create_index([("user_id", 1), ("order_id", 1)])
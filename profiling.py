@@ -0,0 +1,224 @@
+import os
+import sys
+import hmac
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+# Интервал опроса стеков и размер кольцевого буфера профилей на один маршрут
+DEFAULT_INTERVAL_MS = 5
+DEFAULT_BUFFER_SIZE = 20
+# Ограничение числа маршрутов в хранилище; запросы без маршрута (404, сканеры) идут в один общий ключ
+MAX_ROUTES = 100
+UNMATCHED_ROUTE = "<unmatched>"
+OTHER_ROUTES = "<other>"
+PROFILE_HEADER = b"x-profile-token"
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _running_stack(root, frame) -> Optional[List[str]]:
+    """
+    Стек от кадра корутины root до текущего кадра потока, если root сейчас исполняется, иначе None.
+    Кадры event loop и сервера выше root отбрасываются - корень тот же, что у приостановленных сэмплов.
+    """
+    if root is None:
+        return None
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        if frame is root:
+            labels.reverse()
+            return labels
+        frame = frame.f_back
+    return None
+
+
+def _coroutine_stack(coro) -> List[str]:
+    """Стек приостановленной корутины по цепочке cr_await: показывает, что именно она ждет."""
+    labels = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        labels.append(_frame_label(frame))
+        awaited = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+        if awaited is not None and not (hasattr(awaited, "cr_frame") or hasattr(awaited, "gi_frame")):
+            labels.append(f"<await {type(awaited).__name__}>")
+            break
+        coro = awaited
+    return labels
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, task: asyncio.Task, thread_id: int):
+        self.method = method
+        self.path = path
+        self.route = UNMATCHED_ROUTE
+        self.task = task
+        self.thread_id = thread_id
+        self.started_at = datetime.utcnow()
+        self.duration_ms = 0.0
+        self.samples = 0
+        self.stacks: Counter = Counter()
+        self.finished = False
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "started_at_utc": self.started_at.isoformat(),
+            "duration_ms": round(self.duration_ms, 2),
+            "samples": self.samples,
+        }
+
+    def collapsed(self) -> str:
+        """Формат collapsed stacks (flamegraph.pl, speedscope, inferno): 'a;b;c <count>' на строку."""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class _Sampler(threading.Thread):
+    """Фоновый поток, который работает только пока есть профилируемые запросы."""
+
+    def __init__(self, interval: float):
+        super().__init__(name="request-profiler", daemon=True)
+        self.interval = interval
+        self.active: Dict[int, RequestProfile] = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def add(self, profile: RequestProfile) -> None:
+        with self.lock:
+            self.active[id(profile)] = profile
+        self.wakeup.set()
+
+    def remove(self, profile: RequestProfile) -> None:
+        # После выхода из remove() поток больше не трогает профиль: сэмплирование идет под тем же lock
+        with self.lock:
+            profile.finished = True
+            self.active.pop(id(profile), None)
+
+    def run(self) -> None:
+        while True:
+            if not self.active:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            frames = sys._current_frames()
+            with self.lock:
+                for profile in self.active.values():
+                    if not profile.finished:
+                        self._sample(profile, frames)
+            time.sleep(self.interval)
+
+    def _sample(self, profile: RequestProfile, frames) -> None:
+        coro = profile.task.get_coro()
+        labels = _running_stack(getattr(coro, "cr_frame", None), frames.get(profile.thread_id))
+        if labels is None:
+            # Запрос сейчас не исполняется: он ждет I/O или своей очереди в event loop
+            labels = _coroutine_stack(coro) + ["<suspended>"]
+        profile.stacks[";".join(labels)] += 1
+        profile.samples += 1
+
+
+class ProfileStore:
+    """Кольцевые буферы последних профилей, по одному на маршрут (не больше MAX_ROUTES маршрутов)."""
+
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.routes: Dict[str, deque] = {}
+        self.lock = threading.Lock()
+
+    def add(self, profile: RequestProfile) -> None:
+        with self.lock:
+            route = profile.route
+            if route not in self.routes and len(self.routes) >= MAX_ROUTES:
+                route = OTHER_ROUTES
+            self.routes.setdefault(route, deque(maxlen=self.buffer_size)).append(profile)
+
+    def summaries(self) -> Dict[str, List[Dict[str, Any]]]:
+        with self.lock:
+            return {route: [p.summary() for p in profiles] for route, profiles in self.routes.items()}
+
+    def collapsed(self, route: str, index: Optional[int] = None) -> Optional[str]:
+        """Стеки одного профиля (index) или сумма всех профилей маршрута из буфера."""
+        with self.lock:
+            profiles = list(self.routes.get(route, ()))
+        if not profiles:
+            return None
+        if index is not None:
+            if not -len(profiles) <= index < len(profiles):
+                return None
+            return profiles[index].collapsed()
+        total: Counter = Counter()
+        for profile in profiles:
+            total.update(profile.stacks)
+        return "\n".join(f"{stack} {count}" for stack, count in total.most_common())
+
+
+profile_store = ProfileStore(int(os.getenv("PROFILING_BUFFER_SIZE", DEFAULT_BUFFER_SIZE)))
+
+
+class ProfilingMiddleware:
+    """
+    ASGI-middleware для выборочного профилирования запросов.
+    Профилируется запрос с заголовком X-Profile-Token, равным admin-токену, либо доля
+    запросов sample_rate. Без токена и с нулевой долей middleware просто передает запрос дальше.
+    """
+
+    def __init__(self, app, admin_token: Optional[str] = None, sample_rate: float = 0.0,
+                 interval_ms: float = DEFAULT_INTERVAL_MS, store: ProfileStore = profile_store):
+        self.app = app
+        self.admin_token = admin_token.encode() if admin_token else None
+        self.sample_rate = sample_rate
+        self.enabled = bool(self.admin_token) or sample_rate > 0
+        self.store = store
+        self.sampler: Optional[_Sampler] = None
+        self.interval = interval_ms / 1000
+
+    def _should_profile(self, scope) -> bool:
+        if self.admin_token:
+            for name, value in scope.get("headers", ()):
+                if name == PROFILE_HEADER:
+                    return hmac.compare_digest(value, self.admin_token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        if self.sampler is None:
+            self.sampler = _Sampler(self.interval)
+            self.sampler.start()
+
+        profile = RequestProfile(
+            scope.get("method", ""), scope.get("path", ""),
+            asyncio.current_task(), threading.get_ident()
+        )
+        started = time.perf_counter()
+        self.sampler.add(profile)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.sampler.remove(profile)
+            profile.duration_ms = (time.perf_counter() - started) * 1000
+            # FastAPI кладет найденный маршрут в scope; без него запрос относится к UNMATCHED_ROUTE,
+            # чтобы произвольные URL не создавали новые ключи в хранилище
+            route = scope.get("route")
+            if route is not None and getattr(route, "path", None):
+                profile.route = route.path
+            profile.task = None
+            self.store.add(profile)
+            logger.info("Request profiled: %s %s, %.1f ms, %s samples", profile.method, profile.route, profile.duration_ms, profile.samples)
@@ -0,0 +1,218 @@
+import re
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List
+
+from pytz import timezone, utc
+
+logger = logging.getLogger(__name__)
+
+# Коллекция с дневными агрегатами: один документ на пару (day, plan_type)
+ROLLUPS_COLLECTION = "revenue_rollups"
+
+# Дни считаем по Киеву, как и даты подписок в остальном проекте
+KYIV_TZ = timezone('Europe/Kyiv')
+
+# Статусы, которые не считаем ни успешными, ни отклоненными (ждем финального статуса)
+NON_FINAL_STATUSES = {"Pending", "InProcessing", "WaitingAuthComplete", "RefundInProcessing", "widget_params_generated"}
+
+# Скрипты cleanup/sync пишут дату деактивации в last_sync_status: "Deactivated ... on <ISO-дата>"
+_DEACTIVATED_ON_RE = re.compile(r"Deactivated .*on (?P<ts>\d{4}-\d{2}-\d{2}T[\d:.]+)")
+
+# Возврат/отмена ранее одобренного платежа: уменьшает выручку, считается отдельно от отклоненных
+REFUND_STATUSES = {"Refunded", "Voided"}
+
+
+def kyiv_day(dt: Optional[datetime] = None) -> str:
+    """Возвращает дату (YYYY-MM-DD) по Киеву. Naive datetime считается UTC."""
+    if dt is None:
+        return datetime.now(KYIV_TZ).strftime("%Y-%m-%d")
+    if dt.tzinfo is None:
+        dt = utc.localize(dt)
+    return dt.astimezone(KYIV_TZ).strftime("%Y-%m-%d")
+
+
+def plan_type_from_order_ref(order_reference: str) -> str:
+    """Определяет plan_type по префиксу orderReference, если в попытке платежа его нет."""
+    if order_reference.startswith("widget_sub_"):
+        return "subscription"
+    if order_reference.startswith("widget_single_"):
+        return "single"
+    return "unknown"
+
+
+async def ensure_rollup_indexes(db) -> None:
+    await db[ROLLUPS_COLLECTION].create_index([("day", 1), ("plan_type", 1)], unique=True)
+
+
+async def record_payment_status(db, plan_type: str, status: str, amount: float,
+                                previous_status: Optional[str] = None, day: Optional[str] = None) -> None:
+    """
+    Учитывает финальный статус платежа в агрегате за день.
+    Вызывать только при смене статуса попытки, иначе повторные веб-хуки будут посчитаны дважды.
+    Возврат одобренного платежа вычитает сумму из выручки дня возврата и увеличивает refunded_count.
+    """
+    if status in NON_FINAL_STATUSES:
+        return
+    if status == "Approved":
+        inc = {"approved_count": 1, "revenue": amount}
+    elif status in REFUND_STATUSES:
+        if previous_status != "Approved":
+            # Выручка по этому платежу не учитывалась, вычитать нечего
+            return
+        inc = {"refunded_count": 1, "revenue": -amount}
+    else:
+        inc = {"declined_count": 1}
+    await db[ROLLUPS_COLLECTION].update_one(
+        {"day": day or kyiv_day(), "plan_type": plan_type},
+        {"$inc": inc},
+        upsert=True
+    )
+
+
+async def record_active_delta(db, plan_type: str, delta: int, day: Optional[str] = None) -> None:
+    """Изменяет чистый прирост активных подписок за день (+1 активация, -N деактивация)."""
+    if not delta:
+        return
+    await db[ROLLUPS_COLLECTION].update_one(
+        {"day": day or kyiv_day(), "plan_type": plan_type},
+        {"$inc": {"net_active_delta": delta}},
+        upsert=True
+    )
+
+
+async def record_deactivations(db, subscriptions: List[Dict[str, Any]], day: Optional[str] = None) -> None:
+    """Списывает деактивированные подписки из агрегата, группируя их по plan_type."""
+    per_plan: Dict[str, int] = {}
+    for sub in subscriptions:
+        plan_type = sub.get("plan_type") or "unknown"
+        per_plan[plan_type] = per_plan.get(plan_type, 0) + 1
+    for plan_type, count in per_plan.items():
+        await record_active_delta(db, plan_type, -count, day=day)
+
+
+def _empty_rollup(day: str, plan_type: str) -> Dict[str, Any]:
+    return {
+        "day": day,
+        "plan_type": plan_type,
+        "approved_count": 0,
+        "declined_count": 0,
+        "refunded_count": 0,
+        "revenue": 0,
+        "net_active_delta": 0,
+    }
+
+
+def deactivation_day(sub: Dict[str, Any]) -> Optional[str]:
+    """День деактивации подписки: из last_sync_status скриптов cleanup/sync, иначе день после subscription_end."""
+    match = _DEACTIVATED_ON_RE.search(sub.get("last_sync_status") or "")
+    if match:
+        try:
+            return kyiv_day(datetime.fromisoformat(match.group("ts")))
+        except ValueError:
+            pass
+    if not sub.get("subscription_end"):
+        return None
+    try:
+        end_date = datetime.strptime(sub["subscription_end"], "%Y-%m-%d")
+    except ValueError:
+        logger.warning("Invalid subscription_end '%s' for user_id %s during rollup rebuild.", sub.get("subscription_end"), sub.get("user_id"))
+        return None
+    return (end_date + timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+async def rebuild_rollups(db) -> int:
+    """
+    Пересчитывает агрегаты с нуля по payment_attempts и subscriptions. Возвращает количество документов.
+
+    Запускать при остановленных веб-хуках (maintenance): $inc, выполненные веб-хуками во время пересчета,
+    будут потеряны при подмене коллекции.
+
+    История хранит не все события, поэтому результат совпадает с онлайн-учетом не во всем:
+    - платеж учитывается по последнему известному статусу в день последнего веб-хука;
+    - для возвратов (Refunded/Voided) одобрение относится на approved_utc (как и онлайн), а для
+      попыток, записанных до появления этого поля, - на день создания попытки;
+    - подписка дает +1 в день создания (повторные активации после истечения не видны) и -1 в день
+      деактивации из last_sync_status, а если его нет - на следующий день после subscription_end.
+    """
+    rollups: Dict[tuple, Dict[str, Any]] = {}
+
+    def bucket(day: str, plan_type: str) -> Dict[str, Any]:
+        key = (day, plan_type)
+        if key not in rollups:
+            rollups[key] = _empty_rollup(day, plan_type)
+        return rollups[key]
+
+    attempts_cursor = db["payment_attempts"].find(
+        {"status": {"$nin": list(NON_FINAL_STATUSES)}},
+        {"orderReference": 1, "plan_type": 1, "status": 1, "wfp_webhook_received_utc": 1, "created_utc": 1, "approved_utc": 1, "wfp_webhook_data.amount": 1, "amount": 1}
+    )
+    async for attempt in attempts_cursor:
+        order_ref = attempt.get("orderReference") or ""
+        plan_type = attempt.get("plan_type") or plan_type_from_order_ref(order_ref)
+        received = attempt.get("wfp_webhook_received_utc") or attempt.get("created_utc")
+        if not received:
+            continue
+        row = bucket(kyiv_day(received), plan_type)
+        status = attempt.get("status")
+        amount = (attempt.get("wfp_webhook_data") or {}).get("amount", attempt.get("amount", 0)) or 0
+        if status == "Approved":
+            row["approved_count"] += 1
+            row["revenue"] += amount
+        elif status in REFUND_STATUSES:
+            approved_row = bucket(kyiv_day(attempt.get("approved_utc") or attempt.get("created_utc") or received), plan_type)
+            approved_row["approved_count"] += 1
+            approved_row["revenue"] += amount
+            row["refunded_count"] += 1
+            row["revenue"] -= amount
+        else:
+            row["declined_count"] += 1
+
+    subs_cursor = db["subscriptions"].find(
+        {}, {"plan_type": 1, "is_active": 1, "created_at_utc": 1, "subscription_start": 1, "subscription_end": 1, "last_sync_status": 1, "user_id": 1}
+    )
+    async for sub in subs_cursor:
+        plan_type = sub.get("plan_type") or "unknown"
+        created = sub.get("created_at_utc")
+        start_day = kyiv_day(created) if created else sub.get("subscription_start")
+        if not start_day:
+            continue
+        bucket(start_day, plan_type)["net_active_delta"] += 1
+        if not sub.get("is_active"):
+            deactivated_day = deactivation_day(sub)
+            if deactivated_day:
+                bucket(deactivated_day, plan_type)["net_active_delta"] -= 1
+
+    # Пишем во временную коллекцию и атомарно подменяем ею основную: веб-хуки, пришедшие во время
+    # записи, не упадут на уникальном индексе и не увидят частично пустую коллекцию
+    collection = db[ROLLUPS_COLLECTION]
+    if rollups:
+        tmp_collection = db[f"{ROLLUPS_COLLECTION}_rebuild"]
+        await tmp_collection.drop()
+        await tmp_collection.insert_many(list(rollups.values()))
+        await tmp_collection.create_index([("day", 1), ("plan_type", 1)], unique=True)
+        await tmp_collection.rename(ROLLUPS_COLLECTION, dropTarget=True)
+    else:
+        await collection.delete_many({})
+        await ensure_rollup_indexes(db)
+    logger.info("Rollups rebuilt: %s day/plan documents.", len(rollups))
+    return len(rollups)
+
+
+async def get_rollups(db, start_day: str, end_day: str, plan_type: Optional[str] = None) -> Dict[str, Any]:
+    """Возвращает агрегаты за период [start_day, end_day] и итоги по ним."""
+    query: Dict[str, Any] = {"day": {"$gte": start_day, "$lte": end_day}}
+    if plan_type:
+        query["plan_type"] = plan_type
+
+    days = []
+    totals = _empty_rollup(start_day, plan_type or "all")
+    del totals["day"]
+    async for doc in db[ROLLUPS_COLLECTION].find(query, {"_id": 0}).sort([("day", 1), ("plan_type", 1)]):
+        row = _empty_rollup(doc["day"], doc["plan_type"])
+        row.update(doc)
+        days.append(row)
+        for field in ("approved_count", "declined_count", "refunded_count", "revenue", "net_active_delta"):
+            totals[field] += row[field]
+
+    return {"start": start_day, "end": end_day, "days": days, "totals": totals}
@@ -1,4 +1,5 @@
 import os
+import sys
 import asyncio
 import logging
 from datetime import datetime
@@ -7,6 +8,10 @@ from pytz import timezone
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
 
+# Позволяет импортировать модули из корня проекта при запуске скрипта напрямую
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rollups
+
 # Настройка логирования для нашего скрипта
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -48,15 +53,21 @@ async def cleanup_expired():
         
         logging.info(f"Поиск истекших подписок по запросу: {query}")
 
-        # Используем update_many для эффективности: обновляем все найденные документы одним запросом
-        result = await subscriptions_collection.update_many(
-            query,
-            {"$set": {"is_active": 0, "last_sync_status": f"Deactivated by cleanup script on {datetime.utcnow().isoformat()}"}}
-        )
-        
-        deactivated_count = result.modified_count
+        # Деактивируем по одному документу с повторной проверкой условия: если веб-хук успел продлить
+        # подписку между find и update, она не изменится и не будет списана из агрегатов
+        deactivated_subs = []
+        async for sub in subscriptions_collection.find(query, {"_id": 1, "plan_type": 1}):
+            result = await subscriptions_collection.update_one(
+                {"_id": sub["_id"], **query},
+                {"$set": {"is_active": 0, "last_sync_status": f"Deactivated by cleanup script on {datetime.utcnow().isoformat()}"}}
+            )
+            if result.modified_count > 0:
+                deactivated_subs.append(sub)
+
+        deactivated_count = len(deactivated_subs)
 
         if deactivated_count > 0:
+            await rollups.record_deactivations(db, deactivated_subs)
             logging.info(f"Успешно деактивировано {deactivated_count} истекших подписок.")
         else:
             logging.info("Не найдено истекших подписок для деактивации.")
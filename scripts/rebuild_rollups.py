@@ -0,0 +1,52 @@
+import os
+import sys
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+# Позволяет импортировать модули из корня проекта при запуске скрипта напрямую
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rollups
+
+# Настройка логирования для нашего скрипта
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# --- Загрузка конфигурации ---
+load_dotenv()
+MONGO_URI = os.getenv("MONGO_URI")
+
+if not MONGO_URI:
+    logging.error("Критическая ошибка: переменная MONGO_URI не найдена в .env.")
+    exit()
+
+
+async def rebuild():
+    """
+    Полностью пересчитывает коллекцию revenue_rollups по истории payment_attempts и subscriptions.
+    Запускать после миграций или если агрегаты разошлись с данными.
+    ВАЖНО: на время пересчета веб-хуки должны быть остановлены (maintenance), иначе их обновления
+    агрегатов будут потеряны. Пересчет по истории приближенный - см. docstring rollups.rebuild_rollups.
+    """
+    logging.info("--- Начало пересчета агрегатов выручки и подписок ---")
+    logging.warning("Убедитесь, что прием веб-хуков остановлен: обновления агрегатов во время пересчета будут потеряны.")
+
+    mongo_client = None
+    documents_count = 0
+
+    try:
+        mongo_client = AsyncIOMotorClient(MONGO_URI)
+        db = mongo_client["dream_database"]
+        documents_count = await rollups.rebuild_rollups(db)
+    except Exception as e:
+        logging.error(f"Критическая ошибка в процессе пересчета: {e}", exc_info=True)
+    finally:
+        if mongo_client:
+            mongo_client.close()
+        logging.info(f"--- Пересчет завершен. Записано документов: {documents_count}. ---")
+
+
+if __name__ == "__main__":
+    # Эта конструкция позволяет запускать скрипт напрямую из командной строки
+    asyncio.run(rebuild())
@@ -1,4 +1,5 @@
 import os
+import sys
 import asyncio
 import logging
 from datetime import datetime
@@ -7,6 +8,10 @@ import aiohttp
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
 
+# Позволяет импортировать модули из корня проекта при запуске скрипта напрямую
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rollups
+
 # Настройка логирования для нашего скрипта
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -88,11 +93,12 @@ async def sync_statuses():
                         
                         # Обновляем запись в нашей базе
                         result = await subscriptions_collection.update_one(
-                            {"_id": sub["_id"]},
+                            {"_id": sub["_id"], "is_active": 1},
                             {"$set": {"is_active": 0, "last_sync_status": f"Deactivated on {datetime.utcnow().isoformat()}"}}
                         )
                         if result.modified_count > 0:
                             updated_count += 1
+                            await rollups.record_deactivations(db, [sub])
                             logging.info(f"Подписка для user_id {user_id} успешно деактивирована в локальной БД.")
 
                 else:
@@ -0,0 +1,92 @@
+import os
+import signal
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import lifecycle
+import main
+
+
+def test_mongo_client_options_from_env(monkeypatch):
+    monkeypatch.delenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", raising=False)
+    monkeypatch.setenv("MONGO_MAX_POOL_SIZE", "20")
+    options = lifecycle.mongo_client_options()
+    assert options["maxPoolSize"] == 20
+    assert options["minPoolSize"] == 5
+    assert "waitQueueTimeoutMS" not in options
+
+    monkeypatch.setenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "250")
+    assert lifecycle.mongo_client_options()["waitQueueTimeoutMS"] == 250
+
+
+def test_prestop_hook_defers_server_handler_and_passes_second_signal():
+    calls = []
+
+    def server_handler(sig, frame):
+        calls.append("server")
+
+    original = signal.signal(signal.SIGTERM, server_handler)
+
+    async def scenario():
+        restore = lifecycle.install_prestop_hook(lambda: calls.append("not_ready"), delay=0.1)
+        try:
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.sleep(0.02)
+            assert calls == ["not_ready"]
+            await asyncio.sleep(0.15)
+            assert calls == ["not_ready", "server"]
+
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.sleep(0)
+            assert calls == ["not_ready", "server", "server"]
+        finally:
+            restore()
+        assert signal.getsignal(signal.SIGTERM) is server_handler
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        signal.signal(signal.SIGTERM, original)
+
+
+@pytest.fixture
+def readiness(monkeypatch):
+    """Клиент без lifespan: состояние готовности выставляет сам тест."""
+    monkeypatch.setattr(main, "app_ready", False)
+    monkeypatch.setattr(main, "shutting_down", False)
+    ping_result = {"ok": True}
+
+    async def fake_ping(client, timeout):
+        return ping_result["ok"]
+
+    monkeypatch.setattr(lifecycle, "ping_mongo", fake_ping)
+    return TestClient(main.app), ping_result
+
+
+def test_readyz_before_warm_up(readiness):
+    client, _ = readiness
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json() == {"status": "not_ready", "shutting_down": False}
+
+
+def test_readyz_ready_and_after_shutdown_signal(readiness, monkeypatch):
+    client, _ = readiness
+    monkeypatch.setattr(main, "app_ready", True)
+    assert client.get("/readyz").json() == {"status": "ready"}
+
+    main.mark_shutting_down()
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["shutting_down"] is True
+
+
+def test_readyz_when_mongo_ping_fails(readiness, monkeypatch):
+    client, ping_result = readiness
+    monkeypatch.setattr(main, "app_ready", True)
+    ping_result["ok"] = False
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json() == {"status": "mongo_unavailable"}
@@ -0,0 +1,68 @@
+import logging
+
+import pytest
+
+from logging_setup import (
+    REDACTED,
+    DeferredQueueHandler,
+    SamplingFilter,
+    parse_sampling_rates,
+    redact,
+)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("phone='+380 50 1234567'", f"phone='{REDACTED}'"),
+    ('{"email": "john doe@example.com", "amount": 3}', f'{{"email": "{REDACTED}", "amount": 3}}'),
+    ("Received recToken: tok123 for OrderRef: ref", f"Received recToken: {REDACTED} for OrderRef: ref"),
+    ("cardPan=4444****1111 status=Approved", f"cardPan={REDACTED} status=Approved"),
+    ("""b'{"recToken":"zz","amount":1}'""", f"""b'{{"recToken":"{REDACTED}","amount":1}}'"""),
+    ("orderReference: widget_sub_1_X", "orderReference: widget_sub_1_X"),
+    # Сообщение обрезано (%.1000s) внутри значения: закрывающей кавычки нет
+    ("merchantAccount='m' recToken='abcdefgh", f"merchantAccount='m' recToken='{REDACTED}'"),
+    ('{"cardPan": "4444 55', f'{{"cardPan": "{REDACTED}"'),
+])
+def test_redact_rendered_strings(text, expected):
+    assert redact(text) == expected
+
+
+def test_redact_nested_structures():
+    value = {"recToken": "abc", "amount": 300, "nested": [{"cardPan": "44**11", "status": "ok"}], "email": None}
+    assert redact(value) == {
+        "recToken": REDACTED,
+        "amount": 300,
+        "nested": [{"cardPan": REDACTED, "status": "ok"}],
+        "email": None,
+    }
+    assert value["recToken"] == "abc"
+
+
+def _record(name, level):
+    return logging.LogRecord(name, level, __file__, 1, "msg", (), None)
+
+
+def test_sampling_filter_applies_to_child_loggers_and_keeps_warnings():
+    sampling = SamplingFilter({"main": 0.0, "main.keep": 1.0})
+    assert not sampling.filter(_record("main", logging.INFO))
+    assert not sampling.filter(_record("main.webhook", logging.DEBUG))
+    assert sampling.filter(_record("main.keep", logging.INFO))
+    assert sampling.filter(_record("main", logging.WARNING))
+    assert sampling.filter(_record("other", logging.INFO))
+
+
+def test_parse_sampling_rates_clamps_and_skips_invalid():
+    assert parse_sampling_rates("main=0.1, main.webhook=2,bad,x=abc") == {"main": 0.1, "main.webhook": 1.0}
+    assert parse_sampling_rates(None) == {}
+
+
+def test_queue_handler_snapshots_mutable_args():
+    payload = {"status": "before"}
+    record = logging.LogRecord("main", logging.INFO, __file__, 1, "data: %s %s", (payload, [1]), None)
+    prepared = DeferredQueueHandler(None).prepare(record)
+    payload["status"] = "after"
+    assert prepared.getMessage() == "data: {'status': 'before'} [1]"
+
+
+def test_redact_truncated_message():
+    message = "Веб-хук: %.40s" % "merchantAccount='m' recToken='abcdefghijklmnopqrstuvwxyz' amount=1"
+    assert "abcdefgh" not in redact(message)
@@ -0,0 +1,73 @@
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+import order_refs
+
+
+@pytest.fixture
+def frozen_ms(monkeypatch):
+    """Фиксирует time.time() внутри order_refs на одной миллисекунде."""
+    ms = 1_700_000_000_123
+    monkeypatch.setattr(order_refs.time, "time", lambda: ms / 1000)
+    monkeypatch.setattr(order_refs, "_last_ms", -1)
+    monkeypatch.setattr(order_refs, "_last_random", 0)
+    return ms
+
+
+def test_new_order_ids_are_monotonic_within_one_millisecond(frozen_ms):
+    ids = [order_refs.new_order_id() for _ in range(1000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+    assert all(len(i) == order_refs.ORDER_ID_LENGTH for i in ids)
+    assert order_refs.order_id_timestamp(ids[-1]) == datetime.utcfromtimestamp(frozen_ms / 1000)
+
+
+def test_new_order_id_overflow_moves_to_next_millisecond(frozen_ms, monkeypatch):
+    first = order_refs.new_order_id()
+    monkeypatch.setattr(order_refs, "_last_random", order_refs._RANDOM_MAX)
+    second = order_refs.new_order_id()
+    assert second > first
+    assert order_refs.order_id_timestamp(second) - order_refs.order_id_timestamp(first) == timedelta(milliseconds=1)
+
+
+def test_explicit_timestamp_does_not_affect_next_id(frozen_ms):
+    future_id = order_refs.new_order_id(timestamp_ms=frozen_ms + 3_600_000)
+    assert order_refs.order_id_timestamp(future_id) == datetime.utcfromtimestamp((frozen_ms + 3_600_000) / 1000)
+    next_id = order_refs.new_order_id()
+    assert order_refs.order_id_timestamp(next_id) == datetime.utcfromtimestamp(frozen_ms / 1000)
+
+
+def test_make_order_reference_keeps_legacy_layout():
+    new_order = order_refs.make_order_reference("widget_sub", 12345)
+    order_ref = new_order["orderReference"]
+    assert order_ref == f"widget_sub_12345_{new_order['order_id']}"
+    # Прежний разбор в веб-хуке и в rollups продолжает работать
+    assert re.search(r"_(?P<user_id>\d+)_", order_ref).group("user_id") == "12345"
+    assert order_ref.startswith("widget_sub_")
+
+
+@pytest.mark.parametrize("order_ref, expected", [
+    ("widget_single_42_1700000000", ("widget_single", 42, None)),
+    ("widget_sub_42_01HF7Z5M3Q0000000000000000", ("widget_sub", 42, "01HF7Z5M3Q0000000000000000")),
+    ("widget_sub_42_1700000000_WFPREG-1", ("widget_sub", 42, None)),
+    ("widget_sub_42_01HF7Z5M3Q0000000000000000_WFPREG-3", ("widget_sub", 42, None)),
+])
+def test_parse_order_reference(order_ref, expected):
+    assert tuple(order_refs.parse_order_reference(order_ref)) == expected
+
+
+@pytest.mark.parametrize("order_ref", ["", "bad", "widget_sub_abc_123", None])
+def test_parse_order_reference_without_user_id(order_ref):
+    assert order_refs.parse_order_reference(order_ref) is None
+
+
+def test_attempts_created_between_bounds_include_ids_in_range():
+    order_id = order_refs.new_order_id()
+    created = order_refs.order_id_timestamp(order_id)
+    query = order_refs.attempts_created_between(created, created, user_id=7)
+    assert query["order_id"]["$gte"] <= order_id <= query["order_id"]["$lte"]
+    assert query["user_id"] == 7
+    later = order_refs.attempts_created_between(created + timedelta(milliseconds=1), created + timedelta(seconds=1))
+    assert not later["order_id"]["$gte"] <= order_id
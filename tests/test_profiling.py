@@ -0,0 +1,102 @@
+import sys
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import profiling
+from profiling import ProfileStore, ProfilingMiddleware, RequestProfile
+
+
+def _profile(route, stacks=None):
+    profile = RequestProfile("GET", route, None, 0)
+    profile.route = route
+    profile.stacks.update(stacks or {})
+    return profile
+
+
+def test_store_overflow_goes_to_other_routes(monkeypatch):
+    monkeypatch.setattr(profiling, "MAX_ROUTES", 3)
+    store = ProfileStore(buffer_size=2)
+    for i in range(5):
+        store.add(_profile(f"/r{i}"))
+    store.add(_profile("/r0"))
+    summaries = store.summaries()
+    assert set(summaries) == {"/r0", "/r1", "/r2", profiling.OTHER_ROUTES}
+    assert len(summaries["/r0"]) == 2
+    # Буфер маршрута кольцевой, переполнение - общий ключ сверх MAX_ROUTES
+    assert len(summaries[profiling.OTHER_ROUTES]) == 2
+
+
+def test_store_collapsed_index_bounds_and_aggregation():
+    store = ProfileStore()
+    store.add(_profile("/a", {"x;y": 2}))
+    store.add(_profile("/a", {"x;y": 1, "x;z": 5}))
+    assert store.collapsed("/a") == "x;z 5\nx;y 3"
+    assert store.collapsed("/a", 0) == "x;y 2"
+    assert store.collapsed("/a", -1) == "x;z 5\nx;y 1"
+    assert store.collapsed("/a", 2) is None
+    assert store.collapsed("/a", -3) is None
+    assert store.collapsed("/missing") is None
+
+
+def test_should_profile_token_and_rate(monkeypatch):
+    middleware = ProfilingMiddleware(None, admin_token="secret")
+    assert middleware._should_profile({"headers": [(profiling.PROFILE_HEADER, b"secret")]})
+    assert not middleware._should_profile({"headers": [(profiling.PROFILE_HEADER, b"wrong")]})
+    assert not middleware._should_profile({"headers": []})
+
+    sampled = ProfilingMiddleware(None, sample_rate=0.5)
+    monkeypatch.setattr(profiling.random, "random", lambda: 0.4)
+    assert sampled._should_profile({"headers": []})
+    monkeypatch.setattr(profiling.random, "random", lambda: 0.6)
+    assert not sampled._should_profile({"headers": []})
+    assert not ProfilingMiddleware(None).enabled
+
+
+def test_running_stack_starts_at_root_frame():
+    def root():
+        return inner(sys._getframe())
+
+    def inner(root_frame):
+        return profiling._running_stack(root_frame, sys._getframe())
+
+    labels = root()
+    assert labels[0].startswith("root (")
+    assert labels[-1].startswith("inner (")
+    assert len(labels) == 2
+    assert profiling._running_stack(None, sys._getframe()) is None
+
+
+@pytest.fixture
+def profiled_client():
+    store = ProfileStore()
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: int):
+        time.sleep(0.05)
+        return {"item_id": item_id}
+
+    app.add_middleware(ProfilingMiddleware, admin_token="secret", interval_ms=1, store=store)
+    with TestClient(app) as client:
+        yield client, store
+
+
+def test_middleware_profiles_requests_with_token(profiled_client):
+    client, store = profiled_client
+    assert client.get("/items/1").status_code == 200
+    assert store.summaries() == {}
+
+    assert client.get("/items/1", headers={"X-Profile-Token": "secret"}).status_code == 200
+    assert client.get("/nope/123", headers={"X-Profile-Token": "secret"}).status_code == 404
+    summaries = store.summaries()
+    assert set(summaries) == {"/items/{item_id}", profiling.UNMATCHED_ROUTE}
+    profile = summaries["/items/{item_id}"][0]
+    assert profile["path"] == "/items/1"
+    assert profile["samples"] > 0
+    # Стек исполняющегося запроса начинается с корутины задачи, а не с кадров потока/event loop
+    stacks = store.collapsed("/items/{item_id}").splitlines()
+    assert any("get_item (" in stack for stack in stacks)
+    assert not any(stack.startswith("_bootstrap") for stack in stacks)
@@ -0,0 +1,71 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import rollups
+
+
+class RecordingCollection:
+    def __init__(self):
+        self.updates = []
+
+    async def update_one(self, query, update, upsert=False):
+        self.updates.append((query, update))
+
+
+class RecordingDb(dict):
+    def __missing__(self, name):
+        self[name] = RecordingCollection()
+        return self[name]
+
+
+def test_kyiv_day_treats_naive_datetimes_as_utc():
+    assert rollups.kyiv_day(datetime(2024, 1, 1, 22, 30)) == "2024-01-02"
+    assert rollups.kyiv_day(datetime(2024, 7, 1, 20, 59)) == "2024-07-01"
+
+
+@pytest.mark.parametrize("order_ref, plan_type", [
+    ("widget_sub_1_01HF7Z5M3Q0000000000000000", "subscription"),
+    ("widget_single_1_1700000000", "single"),
+    ("manual_1_1700000000", "unknown"),
+])
+def test_plan_type_from_order_ref(order_ref, plan_type):
+    assert rollups.plan_type_from_order_ref(order_ref) == plan_type
+
+
+@pytest.mark.parametrize("status, previous_status, expected_inc", [
+    ("Approved", None, {"approved_count": 1, "revenue": 300}),
+    ("Declined", "widget_params_generated", {"declined_count": 1}),
+    ("Refunded", "Approved", {"refunded_count": 1, "revenue": -300}),
+    ("Voided", "Approved", {"refunded_count": 1, "revenue": -300}),
+    ("Refunded", "Declined", None),
+    ("WaitingAuthComplete", None, None),
+    ("RefundInProcessing", "Approved", None),
+])
+def test_record_payment_status(status, previous_status, expected_inc):
+    db = RecordingDb()
+    asyncio.run(rollups.record_payment_status(db, "subscription", status, 300, previous_status=previous_status, day="2024-01-01"))
+    updates = db[rollups.ROLLUPS_COLLECTION].updates
+    if expected_inc is None:
+        assert updates == []
+    else:
+        assert updates == [({"day": "2024-01-01", "plan_type": "subscription"}, {"$inc": expected_inc})]
+
+
+def test_record_deactivations_groups_by_plan_type():
+    db = RecordingDb()
+    subs = [{"plan_type": "subscription"}, {"plan_type": "subscription"}, {}]
+    asyncio.run(rollups.record_deactivations(db, subs, day="2024-01-01"))
+    assert sorted(update[1]["$inc"]["net_active_delta"] for update in db[rollups.ROLLUPS_COLLECTION].updates) == [-2, -1]
+
+
+@pytest.mark.parametrize("sub, expected", [
+    ({"last_sync_status": "Deactivated by cleanup script on 2024-03-10T22:15:00.123456", "subscription_end": "2024-03-01"}, "2024-03-11"),
+    ({"last_sync_status": "Deactivated on 2024-03-10T10:00:00", "subscription_end": "2024-03-01"}, "2024-03-10"),
+    ({"last_sync_status": "Active", "subscription_end": "2024-03-01"}, "2024-03-02"),
+    ({"subscription_end": "bad"}, None),
+    ({}, None),
+])
+def test_deactivation_day(sub, expected):
+    assert rollups.deactivation_day(sub) == expected